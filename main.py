@@ -4,21 +4,27 @@ with prefixes for one or more given country codes.
 """
 
 import argparse
+import contextlib
+import csv
+import functools
+import json
 import os
-import warnings
+import queue
+import socket
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import pandas as pd
+import lxml.etree
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter, Retry
 from rich.console import Console
 from rich.progress import track
 
-# Suppress FutureWarnings
-warnings.simplefilter(action="ignore", category=FutureWarning)
-
 console = Console(log_path=False)
 
+# Create a new console instance for cleaner logging within the progress bar
+console_no_time = Console(log_path=False, log_time=False)
+
 # Argument parsing
 parser = argparse.ArgumentParser(
     description="Get AS numbers, IPv4, and/or IPv6 allocations of one or more countries"  # noqa: E501
@@ -34,11 +40,39 @@ parser.add_argument(
     default="asn",
     help="Specify which data to fetch: 'asn', 'ipv4', 'ipv6', or 'all'",
 )
+parser.add_argument(
+    "--no-cache",
+    action="store_true",
+    help="Ignore cached pages and download everything again",
+)
+parser.add_argument(
+    "--max-workers",
+    type=int,
+    default=min(32, (os.cpu_count() or 1) + 4),
+    help="Number of pages to fetch in parallel",
+)
 args = parser.parse_args()
+if args.max_workers < 1:
+    parser.error("--max-workers must be at least 1")
 
 # Set Headers
 HEADERS = {"User-Agent": "Mozilla/5.0 (compatible; ASNumberFetcher/1.0)"}
 
+# Request settings
+DEFAULT_TIMEOUT = 30
+MAX_RETRIES = 3
+CHUNK_SIZE = 64 * 1024
+MAX_WORKERS = args.max_workers
+
+# Output locations
+OUTPUT_DIR = "output_data"
+CACHE_DIR = os.path.join(OUTPUT_DIR, ".cache")
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Bump when the layout of cache entries changes, older entries are ignored
+CACHE_VERSION = 3
+CACHE_KEYS = ("version", "etag", "last_modified", "header", "data_rows", "allocations")
+
 # Base URLs
 BASE_URLS = {
     "asn": "https://www-public.imtbs-tsp.eu/~maigron/rir-stats/rir-delegations/delegations/asn/{country}-asn-delegations.html",  # noqa: E501
@@ -46,102 +80,361 @@ BASE_URLS = {
     "ipv6": "https://www-public.imtbs-tsp.eu/~maigron/rir-stats/rir-delegations/delegations/ipv6/{country}-ipv6-delegations.html",  # noqa: E501
 }
 
+# Per data type: URL parts around the country code, and the table class
+URL_PARTS = {data_type: url.split("{country}") for data_type, url in BASE_URLS.items()}
+TABLE_CLASSES = {data_type: f"delegs {data_type} ripencc" for data_type in BASE_URLS}
+
+# Per-thread state of the fetch workers
+_thread_local = threading.local()
+
+# Cache DNS lookups, every URL resolves to the same host
+_getaddrinfo = socket.getaddrinfo
+
+
+@functools.lru_cache(maxsize=32)
+def _cached_getaddrinfo(*lookup_args, **lookup_kwargs):
+    """Resolve an address once and reuse the result for later connections."""
+    return _getaddrinfo(*lookup_args, **lookup_kwargs)
+
+
+socket.getaddrinfo = _cached_getaddrinfo
+
+# Shared session so every worker reuses keep-alive connections to the host
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=MAX_WORKERS,
+        pool_maxsize=MAX_WORKERS * 2,
+        max_retries=Retry(total=MAX_RETRIES, backoff_factor=0.2),
+    ),
+)
+
+
+def load_cache(cache_path):
+    """Load a cached page result, or return None if there is no usable one."""
+    try:
+        with open(cache_path, encoding="UTF-8") as cache_file:
+            entry = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+    # Entries of another version miss keys or store rows differently
+    if not isinstance(entry, dict) or entry.get("version") != CACHE_VERSION:
+        return None
+    if not all(key in entry for key in CACHE_KEYS):
+        return None
+    return entry
+
+
+def save_cache(cache_path, response, header, data_rows, allocations):
+    """Store the parsed result of a page along with its validators."""
+    entry = {
+        "version": CACHE_VERSION,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "header": header,
+        "data_rows": data_rows,
+        "allocations": allocations,
+    }
+    if not entry["etag"] and not entry["last_modified"]:
+        return
 
-def fetch_data(country_code, data_type):
-    """Fetch ASN, IPv4, or IPv6 data for a given country code."""
-    url = BASE_URLS[data_type].format(country=country_code.lower())
     try:
-        response = requests.get(url, headers=HEADERS)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, "lxml")
-
-        # Locate the table
-        table = soup.find(
-            "table",
-            attrs={"class": f"delegs {data_type} ripencc"},
+        with open(cache_path, "w", encoding="UTF-8") as cache_file:
+            json.dump(entry, cache_file)
+    except OSError as e:
+        console.log(f"[yellow]Could not write cache {cache_path}: {e}[/yellow]")
+
+
+def new_pull_parser(encoding):
+    """
+    Create a pull parser for delegation tables that decodes with the encoding.
+
+    Falls back to detecting the encoding from the page, like response.text,
+    when libxml2 does not know the given one.
+    """
+    try:
+        return lxml.etree.HTMLPullParser(
+            events=("start", "end"), tag=("table", "tr"), encoding=encoding
         )
-        if not table:
-            console.log(
-                f"[yellow]No data table found for {data_type.upper()} in {country_code}.[/yellow]"  # noqa: E501
-            )
-            return country_code, data_type, None, None
-
-        # Extract headers and rows
-        headers = [header.text.strip() for header in table.find_all("th")]
-        rows = table.find_all("tr")[2:]
-
-        # Collect data rows
-        data_rows = []
-        allocations = []
-        for row in rows:
-            columns = [td.text.strip() for td in row.find_all("td")]
+    except LookupError:
+        return lxml.etree.HTMLPullParser(events=("start", "end"), tag=("table", "tr"))
+
+
+def read_events(chunks, encoding=None):
+    """
+    Feed body chunks to the parser of the current thread and yield its events.
+
+    Each thread keeps one HTMLPullParser per body encoding and reuses it for
+    every page it fetches. Without an encoding, lxml detects it from the page.
+    The parser is always closed and drained, even on errors, so the next page
+    starts with a clean document.
+    """
+    parsers = getattr(_thread_local, "parsers", None)
+    if parsers is None:
+        parsers = _thread_local.parsers = {}
+    pull_parser = parsers.get(encoding)
+    if pull_parser is None:
+        pull_parser = parsers[encoding] = new_pull_parser(encoding)
+
+    try:
+        for chunk in chunks:
+            pull_parser.feed(chunk)
+            yield from pull_parser.read_events()
+    finally:
+        try:
+            pull_parser.close()
+        except lxml.etree.XMLSyntaxError:
+            pass  # Empty body
+        remaining = list(pull_parser.read_events())
+    yield from remaining
+
+
+def extract_asn(columns):
+    """Return the AS number of an allocated ASN row, or None."""
+    if len(columns) > 6 and columns[6] == "Allocated":
+        return columns[3]
+    return None
+
+
+def extract_ip(columns):
+    """Return the address with prefix of an allocated IPv4/IPv6 row, or None."""
+    if len(columns) > 7 and columns[7] == "Allocated":
+        return columns[3] + columns[4]
+    return None
+
+
+# Allocation extractor of each data type, picked once per table
+EXTRACTORS = {"asn": extract_asn, "ipv4": extract_ip, "ipv6": extract_ip}
+
+
+def parse_table(chunks, data_type, encoding=None):
+    """
+    Stream-parse the delegation table of a page while it is downloaded.
+
+    Rows are handled as soon as they are complete and then dropped from the
+    tree, so neither the whole body nor the whole document is kept in memory.
+    The body is decoded with the given encoding, if any.
+    Returns the CSV header, the data rows as tuples of the header width and
+    the allocations, or None if the table is missing.
+    """
+    table_class = TABLE_CLASSES[data_type]
+    extract = EXTRACTORS[data_type]
+    table = None
+    table_done = False
+    row_count = 0
+    headers = []
+    header = []
+    width = 0
+    data_rows = []
+    allocations = []
+
+    # Bound methods for the per-row loop
+    add_row = data_rows.append
+    add_allocation = allocations.append
+
+    for event, element in read_events(chunks, encoding):
+        if table_done:
+            continue
+
+        # Wait for the opening tag of the delegation table
+        if table is None:
+            if (
+                event == "start"
+                and element.tag == "table"
+                and element.get("class") == table_class
+            ):
+                table = element
+            continue
+
+        if event != "end":
+            continue
+        if element is table:
+            table_done = True
+            continue
+
+        # The first two rows only hold the headers
+        row_count += 1
+        if row_count <= 2:
+            headers.extend("".join(th.itertext()).strip() for th in element.iter("th"))
+            header = headers[1:]
+            width = len(header)
+        else:
+            columns = ["".join(td.itertext()).strip() for td in element.iter("td")]
             if columns:
-                row_data = dict(zip(headers[1:], columns))
-                data_rows.append(row_data)
+                # Fit ragged rows to the header: extra cells are cut and
+                # missing ones are left empty
+                if len(columns) == width:
+                    add_row(tuple(columns))
+                else:
+                    add_row(tuple(columns[:width]) + ("",) * (width - len(columns)))
+
+                allocation = extract(columns)
+                if allocation is not None:
+                    add_allocation(allocation)
 
-                if data_type == "asn" and columns[6] == "Allocated":
-                    allocations.append(columns[3])  # Collect allocated ASNs
-                elif data_type in ["ipv4", "ipv6"] and columns[7] == "Allocated":
-                    ip_with_prefix = f"{columns[3]}{columns[4].strip()}"
-                    allocations.append(ip_with_prefix)
+        # Drop the finished row and the ones before it
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
 
-        return country_code, data_type, data_rows, allocations
+    if table is None:
+        return None
+    return header, data_rows, allocations
+
+
+def fetch_data(country_code, data_type):
+    """Fetch ASN, IPv4, or IPv6 data for a given country code."""
+    url_prefix, url_suffix = URL_PARTS[data_type]
+    url = url_prefix + country_code.lower() + url_suffix
+    cache_path = os.path.join(CACHE_DIR, f"{country_code.lower()}_{data_type}.json")
+    cached = None if args.no_cache else load_cache(cache_path)
+
+    # Ask the server to skip the body if the page has not changed
+    request_headers = {}
+    if cached and cached.get("etag"):
+        request_headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("last_modified"):
+        request_headers["If-Modified-Since"] = cached["last_modified"]
+
+    try:
+        with SESSION.get(
+            url,
+            headers=request_headers,
+            timeout=DEFAULT_TIMEOUT,
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            if cached and response.status_code == 304:
+                return (
+                    country_code,
+                    data_type,
+                    cached["header"],
+                    cached["data_rows"],
+                    cached["allocations"],
+                )
+
+            # Decode with the charset of the Content-Type header, like
+            # response.text, and leave it to lxml when there is none
+            content_type = response.headers.get("Content-Type", "")
+            encoding = response.encoding if "charset=" in content_type.lower() else None
+            parsed = parse_table(response.iter_content(CHUNK_SIZE), data_type, encoding)
+            if parsed is None:
+                console.log(
+                    f"[yellow]No data table found for {data_type.upper()} in {country_code}.[/yellow]"  # noqa: E501
+                )
+                return country_code, data_type, None, None, None
+
+            header, data_rows, allocations = parsed
+            save_cache(cache_path, response, header, data_rows, allocations)
+            return country_code, data_type, header, data_rows, allocations
 
     except requests.exceptions.RequestException as e:
         console.log(
             f"[red]Error fetching {data_type.upper()} data for {country_code}: {e}[/red]"  # noqa: E501
         )
-        return country_code, data_type, None, None
+        return country_code, data_type, None, None, None
+
+
+def save_data(country_code, data_type, header, data_rows):
+    """Save the rows of a country and data type to its CSV file."""
+    csv_filename = os.path.join(OUTPUT_DIR, f"{country_code}_{data_type}_list.csv")
+    tmp_filename = f"{csv_filename}.tmp"
+    try:
+        # Write next to the target and swap it in, so a failed write never
+        # leaves a half-written CSV behind
+        with open(
+            tmp_filename,
+            "w",
+            buffering=WRITE_BUFFER_SIZE,
+            newline="",
+            encoding="UTF-8",
+        ) as csv_file:
+            writer = csv.writer(csv_file, lineterminator="\n")
+            writer.writerow(header)
+            writer.writerows(data_rows)
+        os.replace(tmp_filename, csv_filename)
+    except OSError as e:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_filename)
+        console.log(f"[red]Error saving {csv_filename}: {e}[/red]")
+        return
+
+    # Improve readability with a new console instance
+    console_no_time.log(
+        f" [green]Data saved for {data_type.upper()} in {country_code}[/green]"  # noqa: E501
+    )
+
+
+def writer_loop(save_queue):
+    """Save queued results until the None sentinel arrives."""
+    while (item := save_queue.get()) is not None:
+        save_data(*item)
 
 
 # Run fetch requests in parallel
 country_data = {}
-output_dir = "output_data"
-os.makedirs(output_dir, exist_ok=True)
+os.makedirs(CACHE_DIR, exist_ok=True)
 
 console.log("[blue]Fetching data for countries...[/blue]")
 
+# Fetch each country once, whatever case or how often it was given
+countries = list(dict.fromkeys(country.upper() for country in args.countries))
+
 # Prepare to fetch all specified data types
 data_types = [args.data_type] if args.data_type != "all" else ["asn", "ipv4", "ipv6"]
 
-# Create a new console instance for cleaner logging within the progress bar
-console_no_time = Console(log_path=False, log_time=False)
+# Write CSV files on their own thread so disk I/O overlaps with parsing
+save_queue = queue.Queue()
+writer_thread = threading.Thread(target=writer_loop, args=(save_queue,))
+writer_thread.start()
 
-with ThreadPoolExecutor() as executor:
-    futures = [
-        executor.submit(fetch_data, country, data_type)
-        for country in args.countries
-        for data_type in data_types
-    ]
+try:
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(fetch_data, country, data_type)
+            for country in countries
+            for data_type in data_types
+        ]
 
-    for future in track(
-        as_completed(futures),
-        total=len(futures),
-        description="Processing data...",
-    ):
-        country_code, data_type, data_rows, allocations = future.result()
-        if data_rows is not None:
-            # Save data to CSV for each country and type
-            df = pd.DataFrame(data_rows)
-            csv_filename = os.path.join(
-                output_dir, f"{country_code}_{data_type}_list.csv"
-            )
-            df.to_csv(csv_filename, index=False)
-
-            # Improve readability with a new console instance
-            console_no_time.log(
-                f" [green]Data saved for {data_type.upper()} in {country_code}[/green]"  # noqa: E501
-            )
-
-            # Write IP or ASN ranges to ranges file
-            if data_type in ["asn", "ipv4", "ipv6"]:
-                range_file_path = os.path.join(
-                    output_dir,
-                    f"{data_type}_ranges.txt",
+        for future in track(
+            as_completed(futures),
+            total=len(futures),
+            description="Processing data...",
+        ):
+            country_code, data_type, header, data_rows, allocations = future.result()
+            # Only touch the disk for results that hold something to write
+            if data_rows:
+                save_queue.put((country_code, data_type, header, data_rows))
+            elif data_rows is not None:
+                console.log(
+                    f"[yellow]No rows found for {data_type.upper()} in {country_code}.[/yellow]"  # noqa: E501
                 )
-                with open(range_file_path, "a", encoding="UTF-8") as range_file:
-                    range_file.write(",".join(allocations) + "\n")
+
+            # Keep the ranges until every country is done
+            if allocations:
+                country_data[country_code, data_type] = allocations
+finally:
+    # Wait for the remaining CSV files, even if the fetch loop failed
+    save_queue.put(None)
+    writer_thread.join()
+    SESSION.close()
+
+# Write IP or ASN ranges to ranges file, one line per country in input order.
+# Every requested type is rewritten, empty if nothing was allocated, so no
+# ranges of an earlier run are left behind.
+for data_type in data_types:
+    lines = [
+        ",".join(dict.fromkeys(country_data[country, data_type])) + "\n"
+        for country in countries
+        if (country, data_type) in country_data
+    ]
+    range_file_path = os.path.join(OUTPUT_DIR, f"{data_type}_ranges.txt")
+    with open(range_file_path, "wb") as range_file:
+        range_file.write("".join(lines).encode("UTF-8"))
 
 console.log(
-    f"[green]Completed fetching data for {len(args.countries)} countries.[/green]"  # noqa: E501
+    f"[green]Completed fetching data for {len(countries)} countries.[/green]"  # noqa: E501
 )